@@ -1,13 +1,22 @@
 import argparse
-import json
 import logging
+import mmap
+import os
+import shutil
+import sys
 import uuid
+import zlib
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
 from pathlib import Path
 from typing import Literal
 
+import orjson
 import pika
-from dateutil.parser import parse
+import simdjson
+import zstandard
+from pydantic import Field, model_validator
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -21,10 +30,39 @@ class Settings(BaseSettings):
     RABBITMQ_ROUTING_KEY: str = "all_games_parsed"
     GAMES_RAW_DIR: Path = Path("../bil-cs2-data/games_raw")
     GAMES_FLATTEN_DIR: Path = Path("../bil-cs2-data/games_flatten")
+    GAMES_FLATTEN_SHARDS: int = Field(default=16, gt=0)
+
+    @model_validator(mode="after")
+    def check_flatten_dir(self):
+        raw_dir = self.GAMES_RAW_DIR.resolve()
+        flat_dir = self.GAMES_FLATTEN_DIR.resolve()
+        if flat_dir == raw_dir or flat_dir in raw_dir.parents:
+            raise ValueError("GAMES_FLATTEN_DIR must not be or contain GAMES_RAW_DIR")
+        return self
 
 
 log = logging.getLogger(__name__)
 
+PERSIST_PROPS = pika.BasicProperties(delivery_mode=2)
+PLAYER_STAT_KEYS = (
+    "adr",
+    "kast",
+    "rating",
+    "kills",
+    "deaths",
+    "assists",
+    "headshots",
+    "flash_assists",
+    "first_kills_diff",
+    "k_d_diff",
+)
+ROUND_KEYS = ("round", "ct", "terrorists", "winner_team", "outcome")
+SERIE_TIER_MAP = {"s": 1, "a": 2, "b": 3, "c": 4, "d": 5}
+OUTCOME_MAP = {"exploded": 1, "defused": 2, "eliminated": 3, "timeout": 4}
+SHARD_GLOB = "flatten_*.jsonl.zst"
+SHARD_INDEX_NAME = "index.json"
+ZSTD = zstandard.ZstdCompressor()
+
 
 def parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Game Parser Service")
@@ -47,6 +85,7 @@ def init_rabbitmq(settings: Settings):
     params = pika.URLParameters(settings.RABBITMQ_URL)
     connection = pika.BlockingConnection(params)
     channel = connection.channel()
+    channel.confirm_delivery()
     channel.exchange_declare(
         exchange=settings.RABBITMQ_EXCHANGE, exchange_type="direct", durable=True
     )
@@ -67,30 +106,165 @@ def publish_to_rabbitmq(channel, settings: Settings):
     channel.basic_publish(
         exchange=settings.RABBITMQ_EXCHANGE,
         routing_key=settings.RABBITMQ_ROUTING_KEY,
-        body=json.dumps(event, ensure_ascii=False).encode(),
-        properties=pika.BasicProperties(delivery_mode=2),
+        body=orjson.dumps(event),
+        properties=PERSIST_PROPS,
     )
     log.info("📨 Published event → %s : %s", settings.RABBITMQ_ROUTING_KEY, event)
 
 
-def game_extractor(path_to_dir: Path):
-    json_files = list(path_to_dir.glob("*.json"))
+def _at(node, pointer: str):
+    try:
+        return node.at_pointer(pointer)
+    except (AttributeError, LookupError, TypeError):
+        return None
+
+
+def _to_py(value):
+    if isinstance(value, simdjson.Object):
+        return value.as_dict()
+    if isinstance(value, simdjson.Array):
+        return value.as_list()
+    return value
+
+
+def _leaf(node, pointer: str):
+    return _to_py(_at(node, pointer))
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def project_game(doc: simdjson.Object) -> dict:
+    if not isinstance(doc, simdjson.Object):
+        raise ValueError("top-level JSON value is not an object")
+    return {
+        "id": _leaf(doc, "/id"),
+        "begin_at": _leaf(doc, "/begin_at"),
+        "map": {"id": _leaf(doc, "/map/id")},
+        "match": {
+            "league": {"id": _leaf(doc, "/match/league/id")},
+            "serie": {
+                "id": _leaf(doc, "/match/serie/id"),
+                "tier": _leaf(doc, "/match/serie/tier"),
+            },
+            "tournament": {"id": _leaf(doc, "/match/tournament/id")},
+        },
+        "players": [
+            {
+                "player": {"id": _intern(_leaf(p, "/player/id"))},
+                "team": {"id": _intern(_leaf(p, "/team/id"))},
+                "opponent": {"id": _intern(_leaf(p, "/opponent/id"))},
+                **{k: _to_py(p[k]) for k in PLAYER_STAT_KEYS if k in p},
+            }
+            for p in _at(doc, "/players") or ()
+            if isinstance(p, simdjson.Object)
+        ],
+        "rounds": [
+            {k: _intern(_to_py(rnd.get(k))) for k in ROUND_KEYS}
+            for rnd in _at(doc, "/rounds") or ()
+            if isinstance(rnd, simdjson.Object)
+        ],
+    }
+
+
+def list_game_files(path_to_dir: Path) -> list[Path]:
+    with os.scandir(path_to_dir) as it:
+        json_files = [
+            Path(entry.path)
+            for entry in it
+            if entry.name.endswith(".json") and entry.is_file()
+        ]
     if not json_files:
         raise FileNotFoundError(f"No JSON files found in {path_to_dir}")
-    for file_path in json_files:
-        try:
-            with file_path.open("r", encoding="utf-8") as f:
-                yield json.load(f)
-        except (json.JSONDecodeError, OSError) as e:
-            log.warning(f"Skipping {file_path.name}: {e}")
+    return json_files
+
+
+def could_flatten(raw: bytes | mmap.mmap) -> bool:
+    # flatten_game needs a full team of five players and at least one round.
+    pos = 0
+    for _ in range(5):
+        pos = raw.find(b'"player"', pos) + 1
+        if not pos:
+            return False
+    return raw.find(b'"rounds"') != -1
+
+
+def parse_game(
+    parser: simdjson.Parser, file_path: Path, raw: bytes | mmap.mmap
+) -> dict | None:
+    if not could_flatten(raw):
+        log.debug("Skipping %s: not enough players or rounds", file_path.name)
+        return None
+    try:
+        return project_game(parser.parse(raw))
+    except (ValueError, RuntimeError) as e:
+        log.warning(f"Skipping {file_path.name}: {e}")
+        return None
+
+
+def load_game(parser: simdjson.Parser, file_path: Path) -> dict | None:
+    try:
+        with file_path.open("rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                log.debug("Skipping %s: empty file", file_path.name)
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return parse_game(parser, file_path, mm)
+    except OSError as e:
+        log.warning(f"Skipping {file_path.name}: {e}")
+        return None
+
+
+def shard_path(path_to_dir: Path, game_id: str, n_shards: int) -> Path:
+    shard = zlib.crc32(str(game_id).encode()) % n_shards
+    return path_to_dir / f"flatten_{shard:02d}.jsonl.zst"
 
 
-def save_flattened_game(path_to_dir: Path, game_id: str, data: list[dict]):
-    path_to_dir.mkdir(parents=True, exist_ok=True)
-    file_path = path_to_dir / f"{game_id}.json"
-    with file_path.open("w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2, default=str)
-    log.info("💾 Game %s saved (%d records)", game_id, len(data))
+def encode_flattened_game(data: list[dict]) -> bytes:
+    option = orjson.OPT_APPEND_NEWLINE | orjson.OPT_NON_STR_KEYS
+    payload = b"".join(orjson.dumps(row, default=str, option=option) for row in data)
+    return ZSTD.compress(payload)
+
+
+class ShardWriter:
+    def __init__(self, path_to_dir: Path, n_shards: int):
+        self.path_to_dir = path_to_dir
+        self.n_shards = n_shards
+        self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        for f in self.files.values():
+            f.close()
+
+    def write(self, game_id: str, frame: bytes) -> tuple[str, int, int]:
+        file_path = shard_path(self.path_to_dir, game_id, self.n_shards)
+        f = self.files.get(file_path)
+        if f is None:
+            f = self.files[file_path] = file_path.open("wb")
+        offset = f.tell()
+        f.write(frame)
+        return file_path.name, offset, len(frame)
+
+
+def save_shard_index(path_to_dir: Path, index: dict):
+    payload = orjson.dumps(index, option=orjson.OPT_NON_STR_KEYS)
+    (path_to_dir / SHARD_INDEX_NAME).write_bytes(payload)
+
+
+def publish_shards(staging_dir: Path, flat_dir: Path, index: dict):
+    shards = {shard for shard, _, _ in index.values()}
+    (flat_dir / SHARD_INDEX_NAME).unlink(missing_ok=True)
+    for shard in shards:
+        os.replace(staging_dir / shard, flat_dir / shard)
+    os.replace(staging_dir / SHARD_INDEX_NAME, flat_dir / SHARD_INDEX_NAME)
+    for file_path in flat_dir.glob(SHARD_GLOB):
+        if file_path.name not in shards:
+            file_path.unlink()
+    shutil.rmtree(staging_dir)
 
 
 def flatten_game(game: dict) -> list[dict]:
@@ -98,10 +272,11 @@ def flatten_game(game: dict) -> list[dict]:
     if not game_id:
         return []
     try:
-        begin_at = parse(game.get("begin_at"))
-    except Exception:
+        begin_at = datetime.fromisoformat(game.get("begin_at"))
+    except (TypeError, ValueError):
         log.warning("Skipping game %s: invalid begin_at", game_id)
         return []
+    begin_at_iso = begin_at.isoformat()
     map_id = game.get("map", {}).get("id")
     if not map_id:
         return []
@@ -109,7 +284,7 @@ def flatten_game(game: dict) -> list[dict]:
     league_id = match.get("league", {}).get("id")
     serie = match.get("serie", {})
     serie_id = serie.get("id")
-    serie_tier = {"s": 1, "a": 2, "b": 3, "c": 4, "d": 5}.get(serie.get("tier"))
+    serie_tier = SERIE_TIER_MAP.get(serie.get("tier"))
     tournament_id = match.get("tournament", {}).get("id")
     players = game.get("players", [])
     if len(players) != 10:
@@ -121,29 +296,16 @@ def flatten_game(game: dict) -> list[dict]:
         p_id = p.get("player", {}).get("id")
         t_id = p.get("team", {}).get("id")
         opp_id = p.get("opponent", {}).get("id")
-        if not all([p_id, t_id, opp_id]):
+        if not (p_id and t_id and opp_id):
             continue
-        d_player_stat[p_id] = {
-            k: p.get(k, 0)
-            for k in [
-                "adr",
-                "kast",
-                "rating",
-                "kills",
-                "deaths",
-                "assists",
-                "headshots",
-                "flash_assists",
-                "first_kills_diff",
-                "k_d_diff",
-            ]
-        }
+        d_player_stat[p_id] = {k: p.get(k, 0) for k in PLAYER_STAT_KEYS}
         dd_team_players[t_id].append(p_id)
         d_teams[t_id] = opp_id
     rounds = game.get("rounds", [])
     if len(rounds) < 16 or not rounds or rounds[0].get("round") != 1:
         return []
     games_flatten = []
+    games_flatten_append = games_flatten.append
     for t_id, p_ids in dd_team_players.items():
         if len(set(p_ids)) != 5:
             continue
@@ -151,61 +313,116 @@ def flatten_game(game: dict) -> list[dict]:
         if not t_opp_id or t_opp_id not in dd_team_players:
             continue
         p_opp_ids = dd_team_players[t_opp_id]
+        team_pair = (t_id, t_opp_id)
+        rounds_pre = []
+        for rnd in rounds:
+            ct_id = rnd.get("ct")
+            terrorists_id = rnd.get("terrorists")
+            if not (ct_id and terrorists_id):
+                continue
+            rnd_number = rnd.get("round")
+            if not rnd_number:
+                continue
+            if ct_id not in team_pair or terrorists_id not in team_pair:
+                continue
+            winner_team = rnd.get("winner_team")
+            if not winner_team or winner_team not in team_pair:
+                continue
+            rounds_pre.append(
+                (
+                    int(rnd_number),
+                    int(t_id == ct_id),
+                    OUTCOME_MAP.get(rnd.get("outcome")),
+                    int(winner_team == t_id),
+                )
+            )
         for p_id in p_ids:
             for p_opp_id in p_opp_ids:
-                for rnd in rounds:
-                    ct_id = rnd.get("ct")
-                    terrorists_id = rnd.get("terrorists")
-                    if not all([ct_id, terrorists_id]):
-                        continue
-                    rnd_number = rnd.get("round")
-                    if not rnd_number:
-                        continue
-                    if ct_id not in [t_id, t_opp_id] or terrorists_id not in [
-                        t_id,
-                        t_opp_id,
-                    ]:
-                        continue
-                    winner_team = rnd.get("winner_team")
-                    if not winner_team or winner_team not in [t_id, t_opp_id]:
-                        continue
-                    games_flatten.append(
+                base = {
+                    "game_id": game_id,
+                    "begin_at": begin_at_iso,
+                    "map_id": map_id,
+                    "league_id": league_id,
+                    "serie_id": serie_id,
+                    "serie_tier": serie_tier,
+                    "tournament_id": tournament_id,
+                    "team_id": t_id,
+                    "team_opponent_id": t_opp_id,
+                    "player_id": p_id,
+                    "player_opponent_id": p_opp_id,
+                    **d_player_stat[p_id],
+                }
+                for rnd_number, is_ct, outcome, win in rounds_pre:
+                    games_flatten_append(
                         {
-                            "game_id": game_id,
-                            "begin_at": begin_at.isoformat(),
-                            "map_id": map_id,
-                            "league_id": league_id,
-                            "serie_id": serie_id,
-                            "serie_tier": serie_tier,
-                            "tournament_id": tournament_id,
-                            "team_id": t_id,
-                            "team_opponent_id": t_opp_id,
-                            "player_id": p_id,
-                            "player_opponent_id": p_opp_id,
-                            **d_player_stat[p_id],
-                            "round": int(rnd_number),
-                            "is_ct": int(t_id == ct_id),
-                            "outcome": {
-                                "exploded": 1,
-                                "defused": 2,
-                                "eliminated": 3,
-                                "timeout": 4,
-                            }.get(rnd.get("outcome")),
-                            "win": int(winner_team == t_id),
+                            **base,
+                            "round": rnd_number,
+                            "is_ct": is_ct,
+                            "outcome": outcome,
+                            "win": win,
                         }
                     )
     return games_flatten
 
 
+_worker_parser: simdjson.Parser | None = None
+
+
+def _init_worker(settings: Settings):
+    global _worker_parser
+    configure_logger(settings)
+    _worker_parser = simdjson.Parser()
+
+
+def _process_one(file_path: Path) -> tuple[str, bytes, int] | None:
+    game = load_game(_worker_parser, file_path)
+    if game is None:
+        return None
+    flat_data = flatten_game(game)
+    if not flat_data:
+        return None
+    return flat_data[0]["game_id"], encode_flattened_game(flat_data), len(flat_data)
+
+
 def process_games(settings: Settings) -> list[str]:
-    parsed_games = []
-    for game in game_extractor(settings.GAMES_RAW_DIR):
-        flat_data = flatten_game(game)
-        if flat_data:
-            game_id = flat_data[0]["game_id"]
-            save_flattened_game(settings.GAMES_FLATTEN_DIR, game_id, flat_data)
-            parsed_games.append(game_id)
-    return parsed_games
+    files = list_game_files(settings.GAMES_RAW_DIR)
+    flat_dir = settings.GAMES_FLATTEN_DIR
+    staging_dir = flat_dir / f".tmp-{uuid.uuid4().hex}"
+    staging_dir.mkdir(parents=True)
+    index = {}
+    try:
+        with (
+            ShardWriter(staging_dir, settings.GAMES_FLATTEN_SHARDS) as writer,
+            ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                initializer=_init_worker,
+                initargs=(settings,),
+            ) as ex,
+        ):
+            try:
+                for result in ex.map(_process_one, files, chunksize=8):
+                    if result is None:
+                        continue
+                    game_id, frame, n_records = result
+                    if game_id in index:
+                        log.warning("Skipping duplicate game %s", game_id)
+                        continue
+                    index[game_id] = writer.write(game_id, frame)
+                    log.info(
+                        "💾 Game %s saved to %s (%d records)",
+                        game_id,
+                        index[game_id][0],
+                        n_records,
+                    )
+            except BaseException:
+                ex.shutdown(cancel_futures=True)
+                raise
+        save_shard_index(staging_dir, index)
+    except BaseException:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+    publish_shards(staging_dir, flat_dir, index)
+    return list(index)
 
 
 def main():
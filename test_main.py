@@ -1,17 +1,22 @@
 import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from unittest.mock import MagicMock, patch
 
 import pytest
+import simdjson
+import zstandard
+from pydantic import ValidationError
 
 from main import (
     Settings,
+    ShardWriter,
+    encode_flattened_game,
     flatten_game,
-    game_extractor,
     init_rabbitmq,
+    load_game,
     process_games,
     publish_to_rabbitmq,
-    save_flattened_game,
 )
 
 
@@ -75,26 +80,84 @@ def test_flatten_game_invalid_missing_id():
     assert flatten_game({}) == []
 
 
-def test_save_flattened_game(tmp_dir):
-    data = [{"a": 1}]
-    file_path = tmp_dir / "test"
-    save_flattened_game(file_path, "g1", data)
-    output = json.loads((file_path / "g1.json").read_text())
-    assert output == data
+def test_flatten_game_invalid_begin_at(sample_game):
+    sample_game["begin_at"] = "??"
+    assert flatten_game(sample_game) == []
 
 
-def test_game_extractor_reads_json(tmp_dir):
+def read_frame(path: Path, offset: int, length: int) -> list[dict]:
+    with path.open("rb") as f:
+        f.seek(offset)
+        frame = f.read(length)
+    lines = zstandard.ZstdDecompressor().decompress(frame).splitlines()
+    return [json.loads(line) for line in lines]
+
+
+def test_shard_writer(tmp_dir):
+    with ShardWriter(tmp_dir, n_shards=1) as writer:
+        first = writer.write("g1", encode_flattened_game([{"a": 1}, {"a": 2}]))
+        second = writer.write("g2", encode_flattened_game([{"a": 3}]))
+    assert first[0] == second[0]
+    shard = tmp_dir / first[0]
+    assert read_frame(shard, *first[1:]) == [{"a": 1}, {"a": 2}]
+    assert read_frame(shard, *second[1:]) == [{"a": 3}]
+    with zstandard.ZstdDecompressor().stream_reader(shard.open("rb")) as reader:
+        assert len(reader.read().splitlines()) == 3
+
+
+def test_load_game_reads_json(tmp_dir, sample_game):
     f = tmp_dir / "sample.json"
-    f.write_text(json.dumps({"a": 1}))
-    files = list(game_extractor(tmp_dir))
-    assert len(files) == 1
-    assert files[0]["a"] == 1
+    f.write_text(json.dumps({**sample_game, "unused": {"a": 1}}))
+    game = load_game(simdjson.Parser(), f)
+    assert game["id"] == "game_1"
+    assert "unused" not in game
+
+
+def test_load_game_converts_container_values(tmp_dir, sample_game):
+    sample_game["match"]["serie"]["tier"] = {"name": "a"}
+    sample_game["players"][0]["adr"] = [1, 2]
+    first = tmp_dir / "first.json"
+    first.write_text(json.dumps(sample_game))
+    second = tmp_dir / "second.json"
+    second.write_text(json.dumps({**sample_game, "id": "game_2"}))
+    parser = simdjson.Parser()
+    game = load_game(parser, first)
+    assert game["match"]["serie"]["tier"] == {"name": "a"}
+    assert game["players"][0]["adr"] == [1, 2]
+    assert type(game["players"][0]["adr"]) is list
+    assert load_game(parser, second)["id"] == "game_2"
+
+
+def test_load_game_skips_unsupported_big_int(tmp_dir, caplog, sample_game):
+    f = tmp_dir / "big_int.json"
+    f.write_text(json.dumps({**sample_game, "events": [{"tick": 2**70}]}))
+    assert load_game(simdjson.Parser(), f) is None
+    assert "Skipping big_int.json" in caplog.text
+
+
+def test_load_game_skips_games_without_players(tmp_dir):
+    f = tmp_dir / "sample.json"
+    f.write_text(json.dumps({"id": "g1", "players": [], "rounds": []}))
+    assert load_game(simdjson.Parser(), f) is None
+
+
+def test_load_game_skips_empty_file(tmp_dir):
+    f = tmp_dir / "empty.json"
+    f.write_text("")
+    assert load_game(simdjson.Parser(), f) is None
+
+
+def test_load_game_projection_flattens_like_full_game(tmp_dir, sample_game):
+    f = tmp_dir / "game_1.json"
+    f.write_text(json.dumps(sample_game))
+    projected = load_game(simdjson.Parser(), f)
+    assert flatten_game(projected) == flatten_game(sample_game)
 
 
-def test_game_extractor_handles_invalid_json(tmp_dir, caplog):
+def test_load_game_handles_invalid_json(tmp_dir, caplog, sample_game):
     f = tmp_dir / "broken.json"
-    f.write_text("{ invalid json }")
-    list(game_extractor(tmp_dir))
+    f.write_text(json.dumps(sample_game)[:-10])
+    assert load_game(simdjson.Parser(), f) is None
     assert "Skipping" in caplog.text
 
 
@@ -107,17 +170,111 @@ def test_publish_to_rabbitmq(mock_conn):
     conn, ch = init_rabbitmq(settings)
     publish_to_rabbitmq(ch, settings)
 
+    mock_channel.confirm_delivery.assert_called_once()
     mock_channel.basic_publish.assert_called_once()
     mock_channel.exchange_declare.assert_called()
     mock_channel.queue_bind.asgitsert_called()
     conn.close()
 
 
-@patch("main.flatten_game", return_value=[{"game_id": "g1"}])
-@patch("main.save_flattened_game")
-@patch("main.game_extractor", return_value=[{"id": "g1"}])
-def test_process_games(_, mock_save, __, tmp_dir):
-    settings = Settings(GAMES_RAW_DIR=tmp_dir, GAMES_FLATTEN_DIR=tmp_dir)
+def test_process_games(tmp_path, sample_game):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    (raw_dir / "game_1.json").write_text(json.dumps(sample_game))
+    (raw_dir / "broken.json").write_text("{ invalid json }")
+    (raw_dir / "empty_game.json").write_text(json.dumps({"id": "game_2"}))
+    (raw_dir / "empty_file.json").write_text("")
+    flat_dir = tmp_path / "flat"
+    settings = Settings(GAMES_RAW_DIR=raw_dir, GAMES_FLATTEN_DIR=flat_dir)
     games = process_games(settings)
-    assert games == ["g1"]
-    mock_save.assert_called_once()
+    assert games == ["game_1"]
+    index = json.loads((flat_dir / "index.json").read_text())
+    shard, offset, length = index["game_1"]
+    rows = read_frame(flat_dir / shard, offset, length)
+    assert rows and all(r["game_id"] == "game_1" for r in rows)
+    assert process_games(settings) == ["game_1"]
+    assert len(list(flat_dir.glob("flatten_*.jsonl.zst"))) == 1
+
+
+def test_process_games_skips_duplicate_game_ids(tmp_path, sample_game, caplog):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    (raw_dir / "a.json").write_text(json.dumps(sample_game))
+    (raw_dir / "b.json").write_text(json.dumps(sample_game))
+    flat_dir = tmp_path / "flat"
+    settings = Settings(
+        GAMES_RAW_DIR=raw_dir, GAMES_FLATTEN_DIR=flat_dir, GAMES_FLATTEN_SHARDS=1
+    )
+    assert process_games(settings) == ["game_1"]
+    assert "Skipping duplicate game game_1" in caplog.text
+    (shard,) = flat_dir.glob("flatten_*.jsonl.zst")
+    with zstandard.ZstdDecompressor().stream_reader(shard.open("rb")) as reader:
+        rows = reader.read().splitlines()
+    assert len(rows) == len(flatten_game(sample_game))
+
+
+def test_process_games_failure_keeps_previous_output(tmp_path, sample_game):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    (raw_dir / "game_1.json").write_text(json.dumps(sample_game))
+    flat_dir = tmp_path / "flat"
+    settings = Settings(GAMES_RAW_DIR=raw_dir, GAMES_FLATTEN_DIR=flat_dir)
+    process_games(settings)
+    before = {p.name: p.read_bytes() for p in flat_dir.iterdir()}
+    with patch("main.save_shard_index", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            process_games(settings)
+    assert {p.name: p.read_bytes() for p in flat_dir.iterdir()} == before
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["flat", "raw"]
+
+
+def test_process_games_cancels_queued_files_on_failure(tmp_path, sample_game):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    for i in range(50):
+        game = {**sample_game, "id": f"game_{i}"}
+        (raw_dir / f"game_{i}.json").write_text(json.dumps(game))
+    settings = Settings(GAMES_RAW_DIR=raw_dir, GAMES_FLATTEN_DIR=tmp_path / "flat")
+    shutdown = ProcessPoolExecutor.shutdown
+    with (
+        patch("main.ShardWriter.write", side_effect=OSError("disk full")),
+        patch.object(
+            ProcessPoolExecutor, "shutdown", autospec=True, side_effect=shutdown
+        ) as mock_shutdown,
+    ):
+        with pytest.raises(OSError):
+            process_games(settings)
+    assert mock_shutdown.call_args_list[0].kwargs == {"cancel_futures": True}
+
+
+def test_process_games_keeps_unrelated_files(tmp_path, sample_game):
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    (raw_dir / "game_1.json").write_text(json.dumps(sample_game))
+    flat_dir = tmp_path / "flat"
+    flat_dir.mkdir()
+    (flat_dir / "game_0.json").write_text("[]")
+    (flat_dir / "flatten_99.jsonl.zst").write_bytes(b"stale")
+    settings = Settings(GAMES_RAW_DIR=raw_dir, GAMES_FLATTEN_DIR=flat_dir)
+    assert process_games(settings) == ["game_1"]
+    index = json.loads((flat_dir / "index.json").read_text())
+    assert sorted(p.name for p in flat_dir.iterdir()) == sorted(
+        ["game_0.json", "index.json", index["game_1"][0]]
+    )
+
+
+@pytest.mark.parametrize("flat_subdir", ["", ".."])
+def test_settings_rejects_flatten_dir_containing_raw_dir(tmp_dir, flat_subdir):
+    with pytest.raises(ValidationError):
+        Settings(GAMES_RAW_DIR=tmp_dir, GAMES_FLATTEN_DIR=tmp_dir / flat_subdir)
+
+
+def test_settings_rejects_non_positive_shard_count():
+    with pytest.raises(ValidationError):
+        Settings(GAMES_FLATTEN_SHARDS=0)
+
+
+def test_process_games_no_files(tmp_dir):
+    settings = Settings(GAMES_RAW_DIR=tmp_dir, GAMES_FLATTEN_DIR=tmp_dir / "flat")
+    with pytest.raises(FileNotFoundError):
+        process_games(settings)